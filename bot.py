@@ -771,7 +771,11 @@ def main():
     print("🤖 Запуск бота...")
 
     try:
-        application = Application.builder().token(bot_token).build()
+        builder = Application.builder().token(bot_token)
+        if PLUGINS_AVAILABLE:
+            # Плагины закрывают свои HTTP-сессии при остановке бота
+            builder.post_shutdown(plugin_manager.shutdown_plugins)
+        application = builder.build()
 
          # 1. СНАЧАЛА загружаем плагины (чтобы их обработчики были первыми)
         if PLUGINS_AVAILABLE:
@@ -3,15 +3,144 @@ import os
 import json
 import re
 import asyncio
-from datetime import datetime, timedelta
+import time
+from typing import ClassVar, Dict, Optional, Tuple
+from datetime import datetime
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import ContextTypes, MessageHandler, filters, CommandHandler
+from telegram.ext import ContextTypes, MessageHandler, filters, CommandHandler, ApplicationHandlerStop
 from plugins.plugin_base import BasePlugin
 from plugins.init import plugin_manager
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Быстрый JSON-парсер, если установлен
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Скомпилированные паттерны (компилируются один раз при импорте модуля).
+# Текст запроса приводится к нижнему регистру, поэтому флаг IGNORECASE не нужен.
+# Специальные случаи для популярных валют (USD, EUR, RUB) - одна регулярка вместо шести:
+# сработавшие группы from_* и to_* определяют пару валют.
+# При нескольких запросах в одном сообщении берется самый левый (search),
+# а не первая пара по старому порядку приоритета.
+_SPECIAL_CASES_RE = re.compile(
+    r'(?P<amount>\d+(?:[.,]\d+)?)\s*'
+    r'(?:(?P<from_USD>usd|\$|доллар)|(?P<from_RUB>rub|рубл)|(?P<from_EUR>eur|евро))'
+    r'\s*(?:в|to)\s*'
+    r'(?:(?P<to_USD>usd|\$|доллар)|(?P<to_RUB>rub|рубл)|(?P<to_EUR>eur|евро))'
+)
+_SPECIAL_FROM_GROUPS = {'from_USD': 'USD', 'from_RUB': 'RUB', 'from_EUR': 'EUR'}
+_SPECIAL_TO_GROUPS = {'to_USD': 'USD', 'to_RUB': 'RUB', 'to_EUR': 'EUR'}
+
+# Общие паттерны для распознавания запросов
+_CONVERSION_PATTERNS = [re.compile(p) for p in (
+    # Формат: 100 USD to RUB
+    r'(\d+(?:[.,]\d+)?)\s*([a-zA-Z]{3})\s+(?:to|в|->)\s+([a-zA-Z]{3})',
+    # Формат: 100 долларов в рубли
+    r'(\d+(?:[.,]\d+)?)\s*([a-zA-Zа-яА-Я]{2,})\s+(?:в|to|->)\s+([a-zA-Zа-яА-Я]{2,})',
+    # Формат: конвертировать 100 USD в RUB
+    r'(?:конвертировать|перевести)\s+(\d+(?:[.,]\d+)?)\s+([a-zA-Zа-яА-Я]{2,})\s+(?:в|to|->)\s+([a-zA-Zа-яА-Я]{2,})',
+)]
+
+# Поддерживаемые валюты
+_SUPPORTED_CURRENCIES = {
+    'USD': 'Доллар США', 'EUR': 'Евро', 'GBP': 'Фунт стерлингов',
+    'CNY': 'Китайский юань', 'JPY': 'Японская иена', 'CHF': 'Швейцарский франк',
+    'TRY': 'Турецкая лира', 'KZT': 'Казахстанский тенге', 'RUB': 'Российский рубль'
+}
+# Валюты, которые берутся из ответа ЦБ (RUB - базовая, добавляется вручную)
+_CBR_CURRENCIES = frozenset(_SUPPORTED_CURRENCIES) - {'RUB'}
+
+# Названия валют и их стандартные коды (ключи в нижнем регистре)
+_CURRENCY_MAP = {
+    # Русские названия
+    'рубль': 'RUB', 'руб': 'RUB', 'рублей': 'RUB', 'рубли': 'RUB', 'р': 'RUB',
+    'доллар': 'USD', 'долларов': 'USD', 'доллары': 'USD', 'доллара': 'USD', 'usd': 'USD', '$': 'USD',
+    'евро': 'EUR', 'eur': 'EUR', '€': 'EUR',
+    'юань': 'CNY', 'юаней': 'CNY', 'юаня': 'CNY', 'cny': 'CNY',
+    'фунт': 'GBP', 'фунтов': 'GBP', 'фунта': 'GBP', 'gbp': 'GBP',
+    'иена': 'JPY', 'иен': 'JPY', 'иены': 'JPY', 'yen': 'JPY', 'jpy': 'JPY',
+    'франк': 'CHF', 'франков': 'CHF', 'франка': 'CHF', 'chf': 'CHF',
+    'лира': 'TRY', 'лир': 'TRY', 'лиры': 'TRY', 'try': 'TRY',
+    'тенге': 'KZT', 'kzt': 'KZT',
+}
+# Коды поддерживаемых валют тоже распознаются - одна проверка по словарю вместо двух
+_CURRENCY_MAP.update({code.lower(): code for code in _SUPPORTED_CURRENCIES})
+
+# Флаги валют
+_CURRENCY_FLAGS = {
+    'USD': '🇺🇸',
+    'EUR': '🇪🇺',
+    'CNY': '🇨🇳',
+    'GBP': '🇬🇧',
+    'JPY': '🇯🇵',
+    'CHF': '🇨🇭',
+    'TRY': '🇹🇷',
+    'KZT': '🇰🇿',
+    'RUB': '🇷🇺'
+}
+
+# Шаблоны строк "Все курсы": флаг и код подставлены заранее, остается только значение
+_ALL_RATES_TEMPLATES = [
+    (currency, f"• {_CURRENCY_FLAGS.get(currency, '💱')} *{currency}:* {{:.2f}} ₽")
+    for currency in ('USD', 'EUR', 'CNY', 'GBP', 'JPY', 'CHF', 'TRY', 'KZT')
+]
+
+# Шаблоны строк "Основные валюты": значение и изменение за сутки
+_FIAT_RATES_TEMPLATES = [
+    (currency, f"{_CURRENCY_FLAGS[currency]} *{currency}:* {{:.2f}} ₽ ({{:+.2f}})")
+    for currency in ('USD', 'EUR', 'CNY', 'GBP')
+]
+
+# Предфильтр: любой запрос на конвертацию содержит число
+_DIGIT_RE = re.compile(r'\d')
+_MAX_CONVERSION_REQUEST_LENGTH = 200
+
+# Метка времени ответа в кешируемых текстах: заменяется на текущее время при отправке
+_UPDATED_AT_MARK = "{updated_at}"
+
+# Кнопки меню валют - единственный источник текстов для обработчиков и клавиатур
+_CURRENCY_BUTTON = "💱 Курсы валют"
+_FIAT_BUTTON = "💵 Основные валюты"
+_CONVERTER_BUTTON = "🔄 Конвертер"
+_ALL_RATES_BUTTON = "📊 Все курсы"
+_CHANGES_BUTTON = "📈 Изменения"
+_BACK_BUTTON_TEXT = "◀️ Назад"
+# (filters.Text проверяет точное совпадение вместо регулярки)
+_MENU_BUTTON_TEXTS = (_CURRENCY_BUTTON, _FIAT_BUTTON, _CONVERTER_BUTTON, _ALL_RATES_BUTTON, _CHANGES_BUTTON)
+# Тексты кнопок, которые пропускает обработчик конвертации
+_MENU_STRINGS = frozenset(_MENU_BUTTON_TEXTS) | {_BACK_BUTTON_TEXT}
+
+
+def _label_rate_entry(currency: str, entry: dict) -> dict:
+    """Добавить к курсу флаг и название, чтобы не искать их при каждом ответе"""
+    entry['flag'] = _CURRENCY_FLAGS.get(currency, '💱')
+    entry['name'] = _SUPPORTED_CURRENCIES.get(currency, currency)
+    return entry
+
+
+def _build_rate_entry(currency: str, rate_info: dict) -> dict:
+    """Преобразовать запись ЦБ в курс с рассчитанными изменениями"""
+    value = rate_info['Value']
+    previous = rate_info['Previous']
+    change = value - previous
+    return _label_rate_entry(currency, {
+        'value': value,
+        'previous': previous,
+        'change': change,
+        'change_percent': change / previous * 100 if previous else 0.0
+    })
+
+
+def _convert_amount(amount: float, from_rate: float, to_rate: float) -> float:
+    """Конвертация через RUB: курсы заданы в рублях за единицу, у RUB курс 1.0"""
+    # Сначала конвертируем в RUB, потом в целевую валюту
+    return amount * from_rate / to_rate
+
 
 @plugin_manager.register_plugin(
     name="currency",
@@ -19,26 +148,56 @@ logger = logging.getLogger(__name__)
     version="1.5"
 )
 class CurrencyPlugin(BasePlugin):
+    # Кеши общие для всех экземпляров плагина, чтобы каждый не запрашивал ЦБ отдельно
+    _rates: ClassVar[Optional[dict]] = None  # Последние полученные курсы ЦБ
+    _rates_ts: ClassVar[float] = 0.0  # Время получения курсов (time.monotonic)
+    _rates_validators: ClassVar[Dict[str, str]] = {}  # Заголовки для условного запроса
+    _rendered_cache: ClassVar[Dict[Tuple[str, str], Tuple[float, str]]] = {}  # Готовые тексты представлений
+    _inflight_fetch: ClassVar[Optional[asyncio.Task]] = None  # Текущий запрос к ЦБ, общий для всех ожидающих
+
     def __init__(self):
         super().__init__("currency", "Курсы валют и конвертер", "1.5")
         self.cbr_url = "https://www.cbr-xml-daily.ru/daily_json.js"
-        self.cache = {}
         self.cache_timeout = 300  # 5 минут
-        self.supported_currencies = {
-            'USD': 'Доллар США', 'EUR': 'Евро', 'GBP': 'Фунт стерлингов',
-            'CNY': 'Китайский юань', 'JPY': 'Японская иена', 'CHF': 'Швейцарский франк',
-            'TRY': 'Турецкая лира', 'KZT': 'Казахстанский тенге', 'RUB': 'Российский рубль'
+        self._session: Optional[aiohttp.ClientSession] = None  # Общая сессия для запросов к ЦБ
+        # Обработчики кнопок меню валют
+        self._view_dispatch = {
+            _CURRENCY_BUTTON: self._show_main_menu,
+            _FIAT_BUTTON: self._show_fiat_rates,
+            _CONVERTER_BUTTON: self._show_converter_help,
+            _ALL_RATES_BUTTON: self._show_all_rates,
+            _CHANGES_BUTTON: self._show_changes,
         }
+        self.supported_currencies = _SUPPORTED_CURRENCIES
+        self._supported_codes_str = ', '.join(self.supported_currencies.keys())  # Для сообщений об ошибках
 
     def initialize(self):
         """Инициализация плагина валют"""
         try:
+            # Клавиатуры не меняются, поэтому создаем их один раз
+            self._main_menu_markup = ReplyKeyboardMarkup([
+                [KeyboardButton(_FIAT_BUTTON), KeyboardButton(_ALL_RATES_BUTTON)],
+                [KeyboardButton(_CONVERTER_BUTTON), KeyboardButton(_CHANGES_BUTTON)],
+                [KeyboardButton(_BACK_BUTTON_TEXT)]
+            ], resize_keyboard=True)
+            self._back_markup = ReplyKeyboardMarkup([
+                [KeyboardButton("❓ Помощь"), KeyboardButton("ℹ️ О боте")],
+                [KeyboardButton("🔄 Сбросить диалог"), KeyboardButton("💡 Примеры запросов")],
+                [KeyboardButton("📊 Анализ файлов"), KeyboardButton("🌤️ Погода"), KeyboardButton(_CURRENCY_BUTTON)]
+            ], resize_keyboard=True)
             self.initialized = True
             logger.info(f"✅ Currency plugin initialized v{self.version}")
         except Exception as e:
             logger.error(f"❌ Failed to initialize currency plugin: {e}")
             raise
     
+    async def shutdown(self):
+        """Закрыть HTTP-сессию плагина при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("✅ Currency plugin HTTP session closed")
+        self._session = None
+    
     def setup_handlers(self, application):
         """Настройка обработчиков для плагина валют"""
         # Обработчик команды /currency
@@ -46,21 +205,23 @@ class CurrencyPlugin(BasePlugin):
         
         # Обработчик кнопок валют
         application.add_handler(MessageHandler(
-            filters.Regex(r'^(💱 Курсы валют|💵 Основные валюты|🔄 Конвертер|📊 Все курсы|📈 Изменения)$'),
+            filters.Text(_MENU_BUTTON_TEXTS),
             self.handle_currency_messages
         ))
         
         # Обработчик кнопки "Назад" в контексте валют
         application.add_handler(MessageHandler(
-            filters.Regex(r'^◀️ Назад$'),
+            filters.Text([_BACK_BUTTON_TEXT]),
             self.handle_back_button
         ))
         
         # Обработчик текстовых запросов для конвертера - ВЫСОКИЙ ПРИОРИТЕТ
+        # Отдельная группа -1 проверяется раньше остальных обработчиков (группа 0),
+        # а Regex(\d) отсекает сообщения без цифр еще на уровне фильтров
         application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND,
+            filters.TEXT & ~filters.COMMAND & filters.Regex(_DIGIT_RE),
             self.handle_text_conversion
-        ), group=0)  # Группа 0 - высший приоритет
+        ), group=-1)
         
         logger.info("✅ Currency plugin handlers setup completed")
 
@@ -69,56 +230,43 @@ class CurrencyPlugin(BasePlugin):
         user_message = update.message.text.strip()
         
         # Пропускаем сообщения, которые уже обработаны другими плагинами или являются кнопками
-        if user_message in ["💱 Курсы валют", "💵 Основные валюты", "🔄 Конвертер", 
-                           "📊 Все курсы", "📈 Изменения", "◀️ Назад"]:
+        if user_message in _MENU_STRINGS:
+            return False
+        
+        # В длинных сообщениях запроса на конвертацию быть не может
+        # (сообщения без цифр отсекает фильтр обработчика)
+        if len(user_message) > _MAX_CONVERSION_REQUEST_LENGTH:
             return False
         
         # Проверяем, является ли сообщение запросом на конвертацию
         conversion_data = self._parse_conversion_request(user_message)
         if conversion_data:
-            logger.info(f"🔄 Processing currency conversion: {conversion_data}")
+            logger.debug("🔄 Processing currency conversion: %s", conversion_data)
             await self._process_conversion(update, conversion_data)
-            return True  # Сообщение обработано, останавливаем дальнейшую обработку
+            # Сообщение обработано, останавливаем дальнейшую обработку
+            raise ApplicationHandlerStop
         
-        return False  # Сообщение не обработано, передаем дальше
+        return False  # Сообщение не обработано, передаем дальше (в группу 0)
 
     def _parse_conversion_request(self, text: str) -> dict:
         """Парсит текстовый запрос на конвертацию валют"""
-        # Улучшенные паттерны для распознавания запросов
-        patterns = [
-            # Формат: 100 USD to RUB
-            r'(\d+(?:[.,]\d+)?)\s*([a-zA-Z]{3})\s+(?:to|в|->)\s+([a-zA-Z]{3})',
-            # Формат: 100 долларов в рубли
-            r'(\d+(?:[.,]\d+)?)\s*([a-zA-Zа-яА-Я]{2,})\s+(?:в|to|->)\s+([a-zA-Zа-яА-Я]{2,})',
-            # Формат: конвертировать 100 USD в RUB
-            r'(?:конвертировать|перевести)\s+(\d+(?:[.,]\d+)?)\s+([a-zA-Zа-яА-Я]{2,})\s+(?:в|to|->)\s+([a-zA-Zа-яА-Я]{2,})',
-        ]
+        # Любой запрос на конвертацию начинается с числа - без цифр разбирать нечего
+        if not _DIGIT_RE.search(text):
+            return None
         
         text_lower = text.lower().strip()
-        logger.info(f"🔄 Parsing currency request: '{text}' -> '{text_lower}'")
-        
-        # Специальные случаи для популярных валют
-        special_cases = [
-            # USD to RUB
-            (r'(\d+(?:[.,]\d+)?)\s*(?:usd|\$|доллар)\s*(?:в|to)\s*(?:rub|рубл)', 'USD', 'RUB'),
-            # RUB to USD
-            (r'(\d+(?:[.,]\d+)?)\s*(?:rub|рубл)\s*(?:в|to)\s*(?:usd|\$|доллар)', 'RUB', 'USD'),
-            # EUR to RUB
-            (r'(\d+(?:[.,]\d+)?)\s*(?:eur|евро)\s*(?:в|to)\s*(?:rub|рубл)', 'EUR', 'RUB'),
-            # RUB to EUR
-            (r'(\d+(?:[.,]\d+)?)\s*(?:rub|рубл)\s*(?:в|to)\s*(?:eur|евро)', 'RUB', 'EUR'),
-            # USD to EUR
-            (r'(\d+(?:[.,]\d+)?)\s*(?:usd|\$|доллар)\s*(?:в|to)\s*(?:eur|евро)', 'USD', 'EUR'),
-            # EUR to USD
-            (r'(\d+(?:[.,]\d+)?)\s*(?:eur|евро)\s*(?:в|to)\s*(?:usd|\$|доллар)', 'EUR', 'USD'),
-        ]
+        logger.debug("🔄 Parsing currency request: %r -> %r", text, text_lower)
         
         # Сначала проверяем специальные случаи
-        for pattern, from_curr, to_curr in special_cases:
-            match = re.search(pattern, text_lower, re.IGNORECASE)
-            if match:
-                amount = float(match.group(1).replace(',', '.'))
-                logger.info(f"✅ Special case matched: {amount} {from_curr} -> {to_curr}")
+        match = _SPECIAL_CASES_RE.search(text_lower)
+        if match:
+            # Последней закрывается группа to_*, исходную валюту ищем среди from_*
+            from_curr = next(code for name, code in _SPECIAL_FROM_GROUPS.items() if match.group(name))
+            to_curr = _SPECIAL_TO_GROUPS[match.lastgroup]
+            # Одинаковые валюты специальным случаем не считаются
+            if from_curr != to_curr:
+                amount = float(match.group('amount').replace(',', '.'))
+                logger.debug("✅ Special case matched: %s %s -> %s", amount, from_curr, to_curr)
                 return {
                     'amount': amount,
                     'from_currency': from_curr,
@@ -127,15 +275,15 @@ class CurrencyPlugin(BasePlugin):
                 }
         
         # Затем проверяем общие паттерны
-        for pattern in patterns:
-            match = re.search(pattern, text_lower, re.IGNORECASE)
+        for pattern in _CONVERSION_PATTERNS:
+            match = pattern.search(text_lower)
             if match:
                 amount = float(match.group(1).replace(',', '.'))
                 from_currency = self._normalize_currency(match.group(2))
                 to_currency = self._normalize_currency(match.group(3))
                 
                 if from_currency and to_currency:
-                    logger.info(f"✅ General pattern matched: {amount} {from_currency} -> {to_currency}")
+                    logger.debug("✅ General pattern matched: %s %s -> %s", amount, from_currency, to_currency)
                     return {
                         'amount': amount,
                         'from_currency': from_currency,
@@ -143,44 +291,18 @@ class CurrencyPlugin(BasePlugin):
                         'original_text': text
                     }
                 else:
-                    logger.warning(f"❌ Currency normalization failed: '{match.group(2)}' -> '{from_currency}', '{match.group(3)}' -> '{to_currency}'")
+                    logger.debug("❌ Currency normalization failed: %r -> %r, %r -> %r",
+                                 match.group(2), from_currency, match.group(3), to_currency)
         
-        logger.info(f"❌ No currency patterns matched for: {text}")
+        logger.debug("❌ No currency patterns matched for: %r", text)
         return None
 
     def _normalize_currency(self, currency_str: str) -> str:
         """Нормализует название валюты к стандартному коду"""
-        currency_map = {
-            # Русские названия
-            'рубль': 'RUB', 'руб': 'RUB', 'рублей': 'RUB', 'рубли': 'RUB', 'р': 'RUB',
-            'доллар': 'USD', 'долларов': 'USD', 'доллары': 'USD', 'доллара': 'USD', 'usd': 'USD', '$': 'USD',
-            'евро': 'EUR', 'eur': 'EUR', '€': 'EUR',
-            'юань': 'CNY', 'юаней': 'CNY', 'юаня': 'CNY', 'cny': 'CNY',
-            'фунт': 'GBP', 'фунтов': 'GBP', 'фунта': 'GBP', 'gbp': 'GBP',
-            'иена': 'JPY', 'иен': 'JPY', 'иены': 'JPY', 'yen': 'JPY', 'jpy': 'JPY',
-            'франк': 'CHF', 'франков': 'CHF', 'франка': 'CHF', 'chf': 'CHF',
-            'лира': 'TRY', 'лир': 'TRY', 'лиры': 'TRY', 'try': 'TRY',
-            'тенге': 'KZT', 'kzt': 'KZT',
-        }
-        
-        # Очищаем строку
-        clean_str = currency_str.strip().lower()
-        logger.info(f"🔄 Normalizing currency: '{currency_str}' -> '{clean_str}'")
-        
-        # Проверяем напрямую в мапе
-        if clean_str in currency_map:
-            result = currency_map[clean_str]
-            logger.info(f"✅ Direct map: '{clean_str}' -> '{result}'")
-            return result
-        
-        # Проверяем по коду (если введен код валюты)
-        clean_upper = clean_str.upper()
-        if clean_upper in self.supported_currencies:
-            logger.info(f"✅ Code match: '{clean_upper}'")
-            return clean_upper
-        
-        logger.warning(f"❌ Currency not found: '{clean_str}'")
-        return None
+        result = _CURRENCY_MAP.get(currency_str.strip().lower())
+        if result is None:
+            logger.debug("❌ Currency not found: %r", currency_str)
+        return result
 
     async def _process_conversion(self, update: Update, conversion_data: dict):
         """Обрабатывает конвертацию валют"""
@@ -188,7 +310,7 @@ class CurrencyPlugin(BasePlugin):
         from_curr = conversion_data['from_currency']
         to_curr = conversion_data['to_currency']
         
-        logger.info(f"💱 Starting conversion: {amount} {from_curr} -> {to_curr}")
+        logger.debug("💱 Starting conversion: %s %s -> %s", amount, from_curr, to_curr)
         
         try:
             rates_data = await self._get_cbr_rates()
@@ -198,7 +320,7 @@ class CurrencyPlugin(BasePlugin):
                 logger.error(f"❌ From currency not found: {from_curr}")
                 await update.message.reply_text(
                     f"❌ Валюта '{from_curr}' не найдена.\n"
-                    f"Доступные валюты: {', '.join(self.supported_currencies.keys())}"
+                    f"Доступные валюты: {self._supported_codes_str}"
                 )
                 return
             
@@ -206,7 +328,7 @@ class CurrencyPlugin(BasePlugin):
                 logger.error(f"❌ To currency not found: {to_curr}")
                 await update.message.reply_text(
                     f"❌ Валюта '{to_curr}' не найдена.\n"
-                    f"Доступные валюты: {', '.join(self.supported_currencies.keys())}"
+                    f"Доступные валюты: {self._supported_codes_str}"
                 )
                 return
             
@@ -223,41 +345,31 @@ class CurrencyPlugin(BasePlugin):
             else:
                 to_rate = rates_data[to_curr]['value']
             
-            logger.info(f"📊 Rates: {from_curr} = {from_rate} RUB, {to_curr} = {to_rate} RUB")
+            logger.debug("📊 Rates: %s = %s RUB, %s = %s RUB", from_curr, from_rate, to_curr, to_rate)
             
-            # ПРАВИЛЬНАЯ формула конвертации
-            if from_curr == 'RUB':
-                # Из RUB в другую валюту: сумма / курс целевой валюты
-                result = amount / to_rate
-            elif to_curr == 'RUB':
-                # Из другой валюты в RUB: сумма * курс исходной валюты
-                result = amount * from_rate
-            else:
-                # Конвертация между двумя валютами через RUB
-                # Сначала конвертируем в RUB, потом в целевую валюту
-                amount_in_rub = amount * from_rate
-                result = amount_in_rub / to_rate
+            result = _convert_amount(amount, from_rate, to_rate)
             
             # Форматируем результат
-            from_currency_name = self.supported_currencies.get(from_curr, from_curr)
-            to_currency_name = self.supported_currencies.get(to_curr, to_curr)
+            from_currency_name = rates_data[from_curr]['name']
+            to_currency_name = rates_data[to_curr]['name']
             
-            response = (
+            parts = [
                 f"💱 *Результат конвертации:*\n\n"
                 f"💰 *{amount:.2f} {from_curr}* ({from_currency_name}) = "
                 f"*{result:.2f} {to_curr}* ({to_currency_name})\n\n"
-            )
+            ]
             
             # Добавляем курсы для информации
             if from_curr != 'RUB':
-                response += f"📊 Курс {from_curr}: {from_rate:.2f} RUB\n"
+                parts.append(f"📊 Курс {from_curr}: {from_rate:.2f} RUB\n")
             if to_curr != 'RUB':
-                response += f"📊 Курс {to_curr}: {to_rate:.2f} RUB\n"
+                parts.append(f"📊 Курс {to_curr}: {to_rate:.2f} RUB\n")
             
-            response += f"\n🕐 *Курсы ЦБ РФ на {rates_data.get('date', 'сегодня')}*"
+            parts.append(f"\n🕐 *Курсы ЦБ РФ на {rates_data.get('date', 'сегодня')}*")
+            response = "".join(parts)
             
             await update.message.reply_text(response, parse_mode='Markdown')
-            logger.info(f"✅ Conversion successful: {amount} {from_curr} = {result:.2f} {to_curr}")
+            logger.info("✅ Conversion successful: %s %s = %.2f %s", amount, from_curr, result, to_curr)
             
         except Exception as e:
             logger.error(f"❌ Conversion error: {e}")
@@ -267,58 +379,39 @@ class CurrencyPlugin(BasePlugin):
 
     async def currency_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /currency"""
-        logger.info("Currency command called")
+        logger.debug("Currency command called")
         await self._show_main_menu(update)
 
     async def handle_currency_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик сообщений для плагина валют"""
         user_message = update.message.text
-        logger.info(f"🔄 Currency plugin handling message: {user_message}")
-
-        if user_message == "💱 Курсы валют":
-            await self._show_main_menu(update)
-            return
-
-        if user_message == "💵 Основные валюты":
-            await self._show_fiat_rates(update)
-            return
+        logger.debug("🔄 Currency plugin handling message: %s", user_message)
 
-        if user_message == "🔄 Конвертер":
-            await update.message.reply_text(
-                "💱 Конвертер валют\n\n"
-                "Введите запрос в формате:\n"
-                "`100 USD to RUB`\n"
-                "`1000 RUB to EUR`\n"
-                "`500 долларов в рубли`\n"
-                "`конвертировать 50 евро в доллары`\n\n"
-                "Или выберите из меню выше ⬆️",
-                parse_mode='Markdown'
-            )
-            return
+        handler = self._view_dispatch.get(user_message)
+        if handler:
+            await handler(update)
 
-        if user_message == "📊 Все курсы":
-            await self._show_all_rates(update)
-            return
-
-        if user_message == "📈 Изменения":
-            await self._show_changes(update)
-            return
+    async def _show_converter_help(self, update: Update):
+        """Показать подсказку по конвертеру"""
+        await update.message.reply_text(
+            "💱 Конвертер валют\n\n"
+            "Введите запрос в формате:\n"
+            "`100 USD to RUB`\n"
+            "`1000 RUB to EUR`\n"
+            "`500 долларов в рубли`\n"
+            "`конвертировать 50 евро в доллары`\n\n"
+            "Или выберите из меню выше ⬆️",
+            parse_mode='Markdown'
+        )
 
     async def handle_back_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик кнопки Назад для плагина валют"""
-        logger.info("Currency plugin handling back button")
+        logger.debug("Currency plugin handling back button")
         await self._show_main_menu_back(update)
 
     async def _show_main_menu(self, update: Update):
         """Показать главное меню валют"""
-        logger.info("Showing currency main menu")
-        keyboard = [
-            [KeyboardButton("💵 Основные валюты"), KeyboardButton("📊 Все курсы")],
-            [KeyboardButton("🔄 Конвертер"), KeyboardButton("📈 Изменения")],
-            [KeyboardButton("◀️ Назад")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
+        logger.debug("Showing currency main menu")
         await update.message.reply_text(
             "💱 *Курсы валют и конвертер*\n\n"
             "• 💵 *Основные валюты* - USD, EUR, CNY, GBP\n"
@@ -330,44 +423,29 @@ class CurrencyPlugin(BasePlugin):
             "`500 евро в доллары`\n"
             "`конвертировать 1000 рублей в юани`\n\n"
             "Выберите опцию:",
-            reply_markup=reply_markup,
+            reply_markup=self._main_menu_markup,
             parse_mode='Markdown'
         )
 
     async def _show_fiat_rates(self, update: Update):
         """Показать курсы основных валют"""
-        logger.info("Showing fiat rates")
-        await update.message.reply_text("💵 Получаю курсы валют...")
+        logger.debug("Showing fiat rates")
+        # Из свежего кеша ответ готов сразу - не тратим лишний запрос к Telegram на заглушку
+        if not self._has_fresh_rates():
+            await update.message.reply_text("💵 Получаю курсы валют...")
 
         try:
             rates_data = await self._get_cbr_rates()
-            logger.info(f"Rates data received: {bool(rates_data)}")
+            logger.debug("Rates data received: %s", bool(rates_data))
             
             if not rates_data:
                 await update.message.reply_text("❌ Не удалось получить данные о валютах")
                 return
 
-            usd_rate = rates_data.get('USD', {})
-            eur_rate = rates_data.get('EUR', {})
-            cny_rate = rates_data.get('CNY', {})
-            gbp_rate = rates_data.get('GBP', {})
-
-            response = (
-                "💵 *Курсы ЦБ РФ на сегодня*\n\n"
-                f"🇺🇸 *USD:* {usd_rate.get('value', 'N/A'):.2f} ₽ "
-                f"({usd_rate.get('change', 0):+.2f})\n"
-                f"🇪🇺 *EUR:* {eur_rate.get('value', 'N/A'):.2f} ₽ "
-                f"({eur_rate.get('change', 0):+.2f})\n"
-                f"🇨🇳 *CNY:* {cny_rate.get('value', 'N/A'):.2f} ₽ "
-                f"({cny_rate.get('change', 0):+.2f})\n"
-                f"🇬🇧 *GBP:* {gbp_rate.get('value', 'N/A'):.2f} ₽ "
-                f"({gbp_rate.get('change', 0):+.2f})\n\n"
-                f"🕐 *Обновлено:* {datetime.now().strftime('%H:%M')}\n"
-                f"📅 *Дата:* {rates_data.get('date', 'N/A')}"
-            )
+            response = self._get_or_render('fiat', rates_data, self._render_fiat_rates)
 
             await update.message.reply_text(response, parse_mode='Markdown')
-            logger.info("Fiat rates displayed successfully")
+            logger.debug("Fiat rates displayed successfully")
 
         except Exception as e:
             logger.error(f"Fiat rates error: {e}")
@@ -375,10 +453,26 @@ class CurrencyPlugin(BasePlugin):
                 "❌ Ошибка получения курсов валют. Попробуйте позже."
             )
 
+    def _render_fiat_rates(self, rates_data: dict) -> str:
+        """Сформировать текст с курсами основных валют"""
+        rows = "\n".join(
+            template.format(rates_data[currency]['value'], rates_data[currency]['change'])
+            for currency, template in _FIAT_RATES_TEMPLATES
+        )
+
+        return (
+            "💵 *Курсы ЦБ РФ на сегодня*\n\n"
+            f"{rows}\n\n"
+            f"🕐 *Обновлено:* {_UPDATED_AT_MARK}\n"
+            f"📅 *Дата:* {rates_data.get('date', 'N/A')}"
+        )
+
     async def _show_all_rates(self, update: Update):
         """Показать все курсы валют"""
-        logger.info("Showing all rates")
-        await update.message.reply_text("📊 Получаю все курсы...")
+        logger.debug("Showing all rates")
+        # Из свежего кеша ответ готов сразу - не тратим лишний запрос к Telegram на заглушку
+        if not self._has_fresh_rates():
+            await update.message.reply_text("📊 Получаю все курсы...")
 
         try:
             rates_data = await self._get_cbr_rates()
@@ -386,21 +480,10 @@ class CurrencyPlugin(BasePlugin):
                 await update.message.reply_text("❌ Не удалось получить данные")
                 return
 
-            # Основные валюты
-            main_currencies = ['USD', 'EUR', 'CNY', 'GBP', 'JPY', 'CHF', 'TRY', 'KZT']
-            
-            response = "📊 *Все курсы ЦБ РФ*\n\n"
-            
-            for currency in main_currencies:
-                if currency in rates_data:
-                    rate_data = rates_data[currency]
-                    response += f"• {self._get_currency_flag(currency)} *{currency}:* {rate_data.get('value', 'N/A'):.2f} ₽\n"
-
-            response += f"\n🕐 *Обновлено:* {datetime.now().strftime('%H:%M')}"
-            response += f"\n📅 *Дата:* {rates_data.get('date', 'N/A')}"
+            response = self._get_or_render('all', rates_data, self._render_all_rates)
 
             await update.message.reply_text(response, parse_mode='Markdown')
-            logger.info("All rates displayed successfully")
+            logger.debug("All rates displayed successfully")
 
         except Exception as e:
             logger.error(f"All rates error: {e}")
@@ -408,10 +491,25 @@ class CurrencyPlugin(BasePlugin):
                 "❌ Ошибка получения курсов. Попробуйте позже."
             )
 
+    def _render_all_rates(self, rates_data: dict) -> str:
+        """Сформировать текст со всеми курсами валют"""
+        parts = ["📊 *Все курсы ЦБ РФ*\n"]
+        parts.extend(
+            template.format(rates_data[currency]['value'])
+            for currency, template in _ALL_RATES_TEMPLATES
+            if currency in rates_data
+        )
+        parts.append("")
+        parts.append(f"🕐 *Обновлено:* {_UPDATED_AT_MARK}")
+        parts.append(f"📅 *Дата:* {rates_data.get('date', 'N/A')}")
+        return "\n".join(parts)
+
     async def _show_changes(self, update: Update):
         """Показать изменения курсов"""
-        logger.info("Showing currency changes")
-        await update.message.reply_text("📈 Анализирую изменения...")
+        logger.debug("Showing currency changes")
+        # Из свежего кеша ответ готов сразу - не тратим лишний запрос к Telegram на заглушку
+        if not self._has_fresh_rates():
+            await update.message.reply_text("📈 Анализирую изменения...")
 
         try:
             rates_data = await self._get_cbr_rates()
@@ -419,27 +517,10 @@ class CurrencyPlugin(BasePlugin):
                 await update.message.reply_text("❌ Не удалось получить данные")
                 return
 
-            response = "📈 *Изменения курсов за сутки*\n\n"
-            
-            for currency in ['USD', 'EUR', 'CNY']:
-                if currency in rates_data:
-                    rate_data = rates_data[currency]
-                    change = rate_data.get('change', 0)
-                    change_percent = rate_data.get('change_percent', 0)
-                    
-                    if change > 0:
-                        trend = "📈"
-                    elif change < 0:
-                        trend = "📉"
-                    else:
-                        trend = "➡️"
-                    
-                    response += f"{trend} {self._get_currency_flag(currency)} *{currency}:* {change:+.2f} ₽ ({change_percent:+.1f}%)\n"
-
-            response += f"\n🕐 *Обновлено:* {datetime.now().strftime('%H:%M')}"
+            response = self._get_or_render('changes', rates_data, self._render_changes)
 
             await update.message.reply_text(response, parse_mode='Markdown')
-            logger.info("Currency changes displayed successfully")
+            logger.debug("Currency changes displayed successfully")
 
         except Exception as e:
             logger.error(f"Changes error: {e}")
@@ -447,60 +528,138 @@ class CurrencyPlugin(BasePlugin):
                 "❌ Ошибка анализа изменений. Попробуйте позже."
             )
 
+    def _render_changes(self, rates_data: dict) -> str:
+        """Сформировать текст с изменениями курсов"""
+        parts = ["📈 *Изменения курсов за сутки*\n"]
+        
+        for currency in ['USD', 'EUR', 'CNY']:
+            if currency in rates_data:
+                rate_data = rates_data[currency]
+                change = rate_data.get('change', 0)
+                change_percent = rate_data.get('change_percent', 0)
+                
+                if change > 0:
+                    trend = "📈"
+                elif change < 0:
+                    trend = "📉"
+                else:
+                    trend = "➡️"
+                
+                parts.append(f"{trend} {rate_data['flag']} *{currency}:* {change:+.2f} ₽ ({change_percent:+.1f}%)")
+
+        parts.append("")
+        parts.append(f"🕐 *Обновлено:* {_UPDATED_AT_MARK}")
+        return "\n".join(parts)
+
+    def _get_or_render(self, view_key: str, rates_data: dict, render_fn) -> str:
+        """Получить готовый текст представления из кеша или сформировать заново"""
+        if rates_data is not self._rates:
+            # Мок-данные при недоступном ЦБ не кешируются - и тексты по ним тоже,
+            # иначе по совпавшей дате они подменили бы тексты настоящих курсов
+            text = render_fn(rates_data)
+        else:
+            cache_key = (view_key, rates_data.get('date'))
+            cached = self._rendered_cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[0] < self.cache_timeout:
+                text = cached[1]
+            else:
+                text = render_fn(rates_data)
+                self._rendered_cache[cache_key] = (time.monotonic(), text)
+        return text.replace(_UPDATED_AT_MARK, datetime.now().strftime('%H:%M'))
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Получить общую HTTP-сессию для запросов к ЦБ"""
+        if self._session is None or self._session.closed:
+            # Сессия создается лениво: в initialize() цикл событий еще не запущен.
+            # Курсы обновляются не чаще раза в cache_timeout (300 с), поэтому 60-секундный
+            # keep-alive между обновлениями не доживает - каждое обновление открывает новое
+            # соединение. Пул переиспользует его только для запросов, идущих подряд.
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10),
+                connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300, keepalive_timeout=60)
+            )
+        return self._session
+
+    def _has_fresh_rates(self) -> bool:
+        """Есть ли в кеше курсы, которые еще не устарели"""
+        return self._rates is not None and time.monotonic() - self._rates_ts < self.cache_timeout
+
     async def _get_cbr_rates(self):
         """Получить курсы валют от ЦБ РФ"""
-        cache_key = "cbr_rates"
-        if cache_key in self.cache:
-            cache_time, data = self.cache[cache_key]
-            if datetime.now().timestamp() - cache_time < self.cache_timeout:
-                logger.info("Using cached currency rates")
-                return data
-
+        if self._has_fresh_rates():
+            logger.debug("Using cached currency rates")
+            return self._rates
+
+        # Single-flight: первый промах запускает запрос, остальные ждут его результат
+        # (включая мок-данные при ошибке), а не повторяют запрос друг за другом
+        if CurrencyPlugin._inflight_fetch is None or CurrencyPlugin._inflight_fetch.done():
+            CurrencyPlugin._inflight_fetch = asyncio.ensure_future(self._fetch_cbr_rates())
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(CurrencyPlugin._inflight_fetch)
+
+    async def _fetch_cbr_rates(self):
+        """Загрузить курсы валют от ЦБ РФ и обновить кеш"""
         try:
             logger.info("Fetching fresh currency rates from CBR")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.cbr_url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info(f"✅ Successfully fetched currency rates from CBR. Date: {data.get('Date')}")
-                        
-                        rates = {}
-                        for currency, rate_info in data['Valute'].items():
-                            # Рассчитываем изменения
-                            change = rate_info['Value'] - rate_info['Previous']
-                            change_percent = ((rate_info['Value'] - rate_info['Previous']) / rate_info['Previous']) * 100
-                            
-                            rates[currency] = {
-                                'value': rate_info['Value'],
-                                'previous': rate_info['Previous'],
-                                'change': change,
-                                'change_percent': change_percent
-                            }
-                        
-                        # ВАЖНО: Добавляем RUB вручную, так как это базовая валюта
-                        rates['RUB'] = {
-                            'value': 1.0,
-                            'previous': 1.0,
-                            'change': 0.0,
-                            'change_percent': 0.0
-                        }
-                        
-                        rates['date'] = data['Date'][:10]  # Берем только дату без времени
-                        
-                        # Логируем полученные курсы для отладки
-                        logger.info(f"📊 Received rates for: {list(rates.keys())[:5]}...")  # Первые 5 валют
-                        logger.info(f"📊 USD rate: {rates.get('USD', {}).get('value', 'N/A')}")
-                        logger.info(f"📊 EUR rate: {rates.get('EUR', {}).get('value', 'N/A')}")
-                        logger.info(f"📊 CNY rate: {rates.get('CNY', {}).get('value', 'N/A')}")
-                        
-                        # Кешируем данные
-                        self.cache[cache_key] = (datetime.now().timestamp(), rates)
-                        return rates
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"❌ CBR API error: {response.status} - {error_text}")
-                        logger.info("🔄 Falling back to mock rates")
-                        return self._get_mock_rates()
+            session = await self._get_session()
+            # Условный запрос: ЦБ публикует курсы раз в день, чаще всего ответ будет 304
+            headers = self._rates_validators if self._rates is not None else {}
+            async with session.get(self.cbr_url, headers=headers) as response:
+                if response.status == 304 and self._rates is not None:
+                    logger.info("CBR rates not modified, extending cache")
+                    now = time.monotonic()
+                    CurrencyPlugin._rates_ts = now
+                    # Курсы те же - продлеваем готовые тексты по ним, остальные выбрасываем
+                    current_date = self._rates.get('date')
+                    renewed = {
+                        key: (now, text)
+                        for key, (_, text) in self._rendered_cache.items()
+                        if key[1] == current_date
+                    }
+                    self._rendered_cache.clear()
+                    self._rendered_cache.update(renewed)
+                    return self._rates
+
+                if response.status == 200:
+                    data = _json_loads(await response.read())
+                    logger.info(f"✅ Successfully fetched currency rates from CBR. Date: {data.get('Date')}")
+                    
+                    # Остальные валюты ЦБ бот не показывает - не тратим на них время и память
+                    rates = {
+                        currency: _build_rate_entry(currency, rate_info)
+                        for currency, rate_info in data['Valute'].items()
+                        if currency in _CBR_CURRENCIES
+                    }
+                    
+                    # ВАЖНО: Добавляем RUB вручную, так как это базовая валюта
+                    rates['RUB'] = _build_rate_entry('RUB', {'Value': 1.0, 'Previous': 1.0})
+                    
+                    rates['date'] = data['Date'][:10]  # Берем только дату без времени
+                    
+                    # Логируем полученные курсы для отладки
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("📊 Received rates for: %s...", list(rates.keys())[:5])  # Первые 5 валют
+                        logger.debug("📊 USD rate: %s", rates.get('USD', {}).get('value', 'N/A'))
+                        logger.debug("📊 EUR rate: %s", rates.get('EUR', {}).get('value', 'N/A'))
+                        logger.debug("📊 CNY rate: %s", rates.get('CNY', {}).get('value', 'N/A'))
+                    
+                    # Кешируем данные
+                    validators = {}
+                    if response.headers.get('ETag'):
+                        validators['If-None-Match'] = response.headers['ETag']
+                    if response.headers.get('Last-Modified'):
+                        validators['If-Modified-Since'] = response.headers['Last-Modified']
+                    CurrencyPlugin._rates = rates
+                    CurrencyPlugin._rates_ts = time.monotonic()
+                    CurrencyPlugin._rates_validators = validators
+                    # Тексты, сформированные по старым курсам, больше не актуальны
+                    self._rendered_cache.clear()
+                    return rates
+                else:
+                    error_text = await response.text()
+                    logger.error(f"❌ CBR API error: {response.status} - {error_text}")
+                    logger.info("🔄 Falling back to mock rates")
+                    return self._get_mock_rates()
         except asyncio.TimeoutError:
             logger.error("❌ CBR API request timeout")
             logger.info("🔄 Falling back to mock rates")
@@ -517,7 +676,7 @@ class CurrencyPlugin(BasePlugin):
     def _get_mock_rates(self):
         """Мок-данные для валют (если API недоступно)"""
         logger.info("Using mock currency rates based on actual CBR data")
-        return {
+        rates = {
             'USD': {'value': 80.7321, 'previous': 80.9448, 'change': -0.2127, 'change_percent': -0.26},
             'EUR': {'value': 92.6047, 'previous': 93.7804, 'change': -1.1757, 'change_percent': -1.25},
             'CNY': {'value': 11.2795, 'previous': 11.3434, 'change': -0.0639, 'change_percent': -0.56},
@@ -527,31 +686,13 @@ class CurrencyPlugin(BasePlugin):
             'TRY': {'value': 1.90794, 'previous': 1.91349, 'change': -0.00555, 'change_percent': -0.29},
             'KZT': {'value': 0.15543, 'previous': 0.155361, 'change': 0.000069, 'change_percent': 0.04},
             'RUB': {'value': 1.0, 'previous': 1.0, 'change': 0.0, 'change_percent': 0.0},
-            'date': datetime.now().strftime('%Y-%m-%d')
-        }
-
-    def _get_currency_flag(self, currency: str) -> str:
-        """Получить флаг валюты"""
-        flags = {
-            'USD': '🇺🇸',
-            'EUR': '🇪🇺', 
-            'CNY': '🇨🇳',
-            'GBP': '🇬🇧',
-            'JPY': '🇯🇵',
-            'CHF': '🇨🇭',
-            'TRY': '🇹🇷',
-            'KZT': '🇰🇿',
-            'RUB': '🇷🇺'
         }
-        return flags.get(currency, '💱')
+        for currency, entry in rates.items():
+            _label_rate_entry(currency, entry)
+        rates['date'] = datetime.now().strftime('%Y-%m-%d')
+        return rates
 
     async def _show_main_menu_back(self, update: Update):
         """Вернуться в главное меню бота"""
-        logger.info("Returning to main menu from currency")
-        keyboard = [
-            [KeyboardButton("❓ Помощь"), KeyboardButton("ℹ️ О боте")],
-            [KeyboardButton("🔄 Сбросить диалог"), KeyboardButton("💡 Примеры запросов")],
-            [KeyboardButton("📊 Анализ файлов"), KeyboardButton("🌤️ Погода"), KeyboardButton("💱 Курсы валют")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text("🔙 Возврат в главное меню", reply_markup=reply_markup)
\ No newline at end of file
+        logger.debug("Returning to main menu from currency")
+        await update.message.reply_text("🔙 Возврат в главное меню", reply_markup=self._back_markup)
\ No newline at end of file
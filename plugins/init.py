@@ -79,6 +79,18 @@ class PluginManager:
                 logger.error(f"❌ Failed to initialize plugin {name}: {e}")
                 plugin_data['initialized'] = False
 
+    async def shutdown_plugins(self, application):
+        """Освобождение ресурсов всех плагинов (вызывается в post_shutdown)"""
+        for name, plugin_data in self.plugins.items():
+            plugin_instance = plugin_data.get('instance')
+            if plugin_instance is None or not hasattr(plugin_instance, 'shutdown'):
+                continue
+            try:
+                await plugin_instance.shutdown()
+                logger.info(f"✅ Plugin shut down: {name}")
+            except Exception as e:
+                logger.error(f"❌ Failed to shut down plugin {name}: {e}")
+
     def get_plugin(self, name: str):
         """Получить экземпляр плагина"""
         plugin_data = self.plugins.get(name, {})
@@ -34,6 +34,10 @@ class BasePlugin(ABC):
         """Внутренний метод инициализации, может быть переопределен"""
         pass
 
+    async def shutdown(self):
+        """Освобождение ресурсов плагина при остановке бота, может быть переопределен"""
+        pass
+
     def get_user_data(self, user_id: int) -> Dict:
         """Получить данные пользователя"""
         if user_id not in self.user_data:
@@ -1,10 +1,13 @@
 import pytest
 import asyncio
+import time
 from unittest.mock import AsyncMock, Mock, patch
 
 # Импортируем правильные классы из вашего кода
 from utils.text_filter import UltraTextFilter
 from utils.context_manager import ContextManager, UserContext
+from plugins.currency_plugin import CurrencyPlugin, _MENU_BUTTON_TEXTS, _BACK_BUTTON_TEXT
+from telegram.ext import ApplicationHandlerStop
 
 class TestTextFilter:
     def setup_method(self):
@@ -86,6 +89,239 @@ class TestContextManager:
         assert context.current_file_text is None
         assert context.current_file_type is None
 
+class TestCurrencyParsing:
+    def setup_method(self):
+        self.plugin = CurrencyPlugin()
+
+    def test_special_case(self):
+        """Тестирование специальных случаев популярных валют"""
+        result = self.plugin._parse_conversion_request("100$ в рубли")
+        assert result['amount'] == 100.0
+        assert result['from_currency'] == 'USD'
+        assert result['to_currency'] == 'RUB'
+
+        result = self.plugin._parse_conversion_request("10,5 евро в доллары")
+        assert result['amount'] == 10.5
+        assert result['from_currency'] == 'EUR'
+        assert result['to_currency'] == 'USD'
+
+    def test_general_pattern(self):
+        """Тестирование общих паттернов конвертации"""
+        result = self.plugin._parse_conversion_request("конвертировать 50 юаней в тенге")
+        assert result['amount'] == 50.0
+        assert result['from_currency'] == 'CNY'
+        assert result['to_currency'] == 'KZT'
+
+    def test_leftmost_request_wins(self):
+        """Тестирование выбора самого левого запроса в сообщении"""
+        result = self.plugin._parse_conversion_request("5 rub в usd 3 usd в rub")
+        assert (result['amount'], result['from_currency'], result['to_currency']) == (5.0, 'RUB', 'USD')
+
+        # Пара одинаковых валют не скрывается за следующей парой
+        result = self.plugin._parse_conversion_request("1 usd to usd or 2 usd to rub")
+        assert (result['amount'], result['from_currency'], result['to_currency']) == (1.0, 'USD', 'USD')
+
+    def test_not_conversion(self):
+        """Тестирование сообщений, не являющихся запросом на конвертацию"""
+        assert self.plugin._parse_conversion_request("привет") is None
+        assert self.plugin._parse_conversion_request("12 яблок в груши") is None
+
+CBR_PAYLOAD = (
+    b'{"Date": "2026-10-14T11:30:00+03:00", "Valute": {'
+    b'"USD": {"Value": 90.5, "Previous": 90.0}, '
+    b'"EUR": {"Value": 99.0, "Previous": 100.0}, '
+    b'"CNY": {"Value": 12.5, "Previous": 12.5}, '
+    b'"GBP": {"Value": 110.0, "Previous": 109.0}, '
+    b'"XDR": {"Value": 120.0, "Previous": 119.0}}}'
+)
+
+class FakeCBRResponse:
+    """Ответ aiohttp для подмены запросов к ЦБ"""
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        # Отдаем управление циклу, как при настоящем сетевом запросе
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode()
+
+def make_fake_session(*responses):
+    """Сессия, которая по очереди отдает заданные ответы"""
+    session = Mock()
+    session.closed = False
+    session.get = Mock(side_effect=list(responses))
+    return session
+
+class TestCurrencyRatesFetch:
+    def setup_method(self):
+        self._reset_rates_cache()
+        self.plugin = CurrencyPlugin()
+
+    def teardown_method(self):
+        self._reset_rates_cache()
+
+    @staticmethod
+    def _reset_rates_cache():
+        """Кеш курсов общий для всех экземпляров - сбрасываем его между тестами"""
+        CurrencyPlugin._rates = None
+        CurrencyPlugin._rates_ts = 0.0
+        CurrencyPlugin._rates_validators = {}
+        CurrencyPlugin._rendered_cache = {}
+        CurrencyPlugin._inflight_fetch = None
+
+    @pytest.mark.asyncio
+    async def test_concurrent_callers_share_one_fetch(self):
+        """Тестирование одного запроса к ЦБ на всех одновременных вызывающих"""
+        session = make_fake_session(FakeCBRResponse(200, CBR_PAYLOAD))
+        self.plugin._session = session
+
+        results = await asyncio.gather(*(self.plugin._get_cbr_rates() for _ in range(5)))
+
+        assert session.get.call_count == 1
+        assert all(result is results[0] for result in results)
+        assert results[0] is CurrencyPlugin._rates
+        assert results[0]['USD']['value'] == 90.5
+        assert 'XDR' not in results[0]
+
+    @pytest.mark.asyncio
+    async def test_concurrent_callers_share_mock_fallback(self):
+        """Тестирование общих мок-данных для всех ожидающих при ошибке ЦБ"""
+        session = make_fake_session(FakeCBRResponse(500, b"Internal Server Error"))
+        self.plugin._session = session
+
+        results = await asyncio.gather(*(self.plugin._get_cbr_rates() for _ in range(5)))
+
+        assert session.get.call_count == 1
+        assert all(result is results[0] for result in results)
+        assert results[0]['USD']['value'] == 80.7321
+        # Мок-данные не кешируются: следующий вызов снова пойдет в ЦБ
+        assert CurrencyPlugin._rates is None
+
+    @pytest.mark.asyncio
+    async def test_conditional_get_not_modified(self):
+        """Тестирование условного запроса: 304 продлевает кеш без перерисовки"""
+        validators = {'ETag': '"abc"', 'Last-Modified': 'Tue, 14 Oct 2026 08:30:00 GMT'}
+        session = make_fake_session(
+            FakeCBRResponse(200, CBR_PAYLOAD, headers=validators),
+            FakeCBRResponse(304),
+        )
+        self.plugin._session = session
+
+        rates = await self.plugin._get_cbr_rates()
+        assert session.get.call_args.kwargs['headers'] == {}
+        self.plugin._get_or_render('fiat', rates, self.plugin._render_fiat_rates)
+
+        # Кеш устарел - следующий вызов идет в ЦБ с валидаторами
+        expired_ts = time.monotonic() - self.plugin.cache_timeout - 1
+        CurrencyPlugin._rates_ts = expired_ts
+        rendered = {key: text for key, (_, text) in CurrencyPlugin._rendered_cache.items()}
+        CurrencyPlugin._rendered_cache.update({key: (expired_ts, text) for key, text in rendered.items()})
+        # Текст по другим курсам продлевать нельзя
+        CurrencyPlugin._rendered_cache[('fiat', '2026-10-13')] = (expired_ts, "stale")
+        result = await self.plugin._get_cbr_rates()
+
+        assert session.get.call_count == 2
+        assert session.get.call_args.kwargs['headers'] == {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Tue, 14 Oct 2026 08:30:00 GMT',
+        }
+        assert result is rates
+        assert CurrencyPlugin._rates is rates
+        assert CurrencyPlugin._rates_ts > expired_ts
+        # Готовые тексты по текущим курсам сохраняются и продлеваются, чужие удаляются
+        assert {key: text for key, (_, text) in CurrencyPlugin._rendered_cache.items()} == rendered
+        assert all(ts > expired_ts for ts, _ in CurrencyPlugin._rendered_cache.values())
+
+    @pytest.mark.asyncio
+    async def test_mock_fallback_not_served_as_real_rates(self):
+        """Тестирование 200 -> 500 -> 304: тексты по мок-данным не попадают в кеш"""
+        session = make_fake_session(
+            FakeCBRResponse(200, CBR_PAYLOAD, headers={'ETag': '"abc"'}),
+            FakeCBRResponse(500, b"Internal Server Error"),
+            FakeCBRResponse(304),
+        )
+        self.plugin._session = session
+        # Дата мок-данных совпадает с датой настоящих курсов
+        mock_rates = self.plugin._get_mock_rates()
+        mock_rates['date'] = '2026-10-14'
+
+        rates = await self.plugin._get_cbr_rates()
+        self.plugin._get_or_render('fiat', rates, self.plugin._render_fiat_rates)
+
+        CurrencyPlugin._rates_ts = time.monotonic() - self.plugin.cache_timeout - 1
+        with patch.object(self.plugin, '_get_mock_rates', return_value=mock_rates):
+            fallback = await self.plugin._get_cbr_rates()
+        assert fallback is mock_rates
+        assert "*USD:* 80.73" in self.plugin._get_or_render('fiat', fallback, self.plugin._render_fiat_rates)
+
+        CurrencyPlugin._rates_ts = time.monotonic() - self.plugin.cache_timeout - 1
+        assert await self.plugin._get_cbr_rates() is rates
+        assert "*USD:* 90.50" in self.plugin._get_or_render('fiat', rates, self.plugin._render_fiat_rates)
+        assert all("80.73" not in text for _, text in CurrencyPlugin._rendered_cache.values())
+
+def make_text_update(text):
+    """Update с текстовым сообщением и подмененным reply_text"""
+    update = Mock()
+    update.message.text = text
+    update.message.reply_text = AsyncMock()
+    return update
+
+class TestCurrencyTextHandler:
+    def setup_method(self):
+        self.plugin = CurrencyPlugin()
+        self.plugin.initialize()
+
+    def test_registered_before_other_handlers(self):
+        """Тестирование регистрации конвертера в группе -1"""
+        application = Mock()
+        self.plugin.setup_handlers(application)
+
+        groups = {
+            call.args[0].callback: call.kwargs.get('group', 0)
+            for call in application.add_handler.call_args_list
+        }
+        assert groups[self.plugin.handle_text_conversion] == -1
+        assert groups[self.plugin.handle_currency_messages] == 0
+
+    def test_menu_buttons_have_views(self):
+        """Тестирование соответствия кнопок меню и их обработчиков"""
+        assert set(self.plugin._view_dispatch) == set(_MENU_BUTTON_TEXTS)
+        keyboard_texts = {button.text for row in self.plugin._main_menu_markup.keyboard for button in row}
+        assert keyboard_texts <= set(_MENU_BUTTON_TEXTS) | {_BACK_BUTTON_TEXT}
+
+    @pytest.mark.asyncio
+    async def test_conversion_stops_other_handlers(self):
+        """Тестирование остановки обработки после конвертации"""
+        update = make_text_update("100 usd to rub")
+        with patch.object(self.plugin, '_get_cbr_rates', AsyncMock(return_value=self.plugin._get_mock_rates())):
+            with pytest.raises(ApplicationHandlerStop):
+                await self.plugin.handle_text_conversion(update, Mock())
+
+        result_text = update.message.reply_text.call_args.args[0]
+        assert "*100.00 USD* (Доллар США) = *8073.21 RUB*" in result_text
+
+    @pytest.mark.asyncio
+    async def test_non_conversion_passes_through(self):
+        """Тестирование пропуска сообщений с цифрами, не являющихся конвертацией"""
+        for text in ("📊 На 5 дней", "встреча в 10 утра"):
+            update = make_text_update(text)
+            with patch.object(self.plugin, '_get_cbr_rates', AsyncMock()) as get_rates:
+                assert await self.plugin.handle_text_conversion(update, Mock()) is False
+
+            get_rates.assert_not_called()
+            update.message.reply_text.assert_not_called()
+
 @pytest.mark.asyncio
 async def test_ai_response_generation():
     """Тестирование генерации ответа AI"""